@@ -1,8 +1,14 @@
+import os
 import time
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SharedMemoryManager
+
+import numpy as np
+
 from modules.config import AppConfig
 from modules.classes.mimic_parser import MimicParser
-from modules.classes.mimic_pre_processor import MimicPreProcessor
+from modules.classes.mimic_pre_processor import MimicPreProcessor, share_data_frame
 from modules.utils.handle_directories import get_pickle_folder
 from modules.models.attention_models import AttentionLSTM
 from modules.models.comparison_models import ComparisonLSTM, ComparisonFNN, ComparisonLogisticRegression
@@ -11,6 +17,35 @@ from modules.train_model import train_model, train_xgb
 from modules.utils.handle_pytorch import load_data_sets
 
 
+def pre_process_targets(shared_data, targets, n_time_steps, pickled_data_path, random_seed, balance_set):
+    """
+    Creates the data sets for one set of targets, meant to be run in its own process
+    Parameters
+    ----------
+    shared_data: dict
+        description of the parsed mimic data in shared memory as returned by share_data_frame
+    targets: list[str]
+        target column(s)
+    n_time_steps: int
+        number of time step for one sample
+    pickled_data_path: str
+        target folder for saved files
+    random_seed: int
+        seed for setting random functions
+    balance_set: bool
+        whether to balance the data
+    """
+    # Forked workers inherit the same global numpy state, seed it so that balancing is reproducible
+    np.random.seed(random_seed)
+    mimic_pp = MimicPreProcessor(None, random_seed=random_seed, shared_data=shared_data)
+    mimic_pp.apply_pipeline(targets, n_time_steps, pickled_data_path, balance_set=balance_set)
+    # The frame views the shared buffers, so it has to be released before the blocks can be closed
+    shared_memories = mimic_pp.shared_memories
+    del mimic_pp
+    for shared_memory in shared_memories:
+        shared_memory.close()
+
+
 def train_models(mimic_version, data_path, n_time_steps, random_seed, targets):
     """
     Training loop for training models with targets and percentages
@@ -112,16 +147,30 @@ def main(parse_mimic, pre_process_data, create_models):
     if pre_process_data:
         print('Preprocess Data')
         if mimic_version == 3:
-            parsed_mimic_filepath = mimic_parser.an_path + '.csv'
+            parsed_mimic_filepath = mimic_parser.an_path
         else:
-            parsed_mimic_filepath = mimic_parser.aii_path + '.csv'
-
-        mimic_pp = MimicPreProcessor(parsed_mimic_filepath, random_seed=random_seed)
+            parsed_mimic_filepath = mimic_parser.aii_path
+        if not os.path.exists(parsed_mimic_filepath + '.parquet'):
+            mimic_parser.convert_to_parquet(parsed_mimic_filepath)
 
         print(f'Creating Datasets for {targets}')
-        mimic_pp.apply_pipeline(targets, n_time_steps, pickled_data_path, balance_set=AppConfig.balance_data)
-        for target in targets:
-            mimic_pp.apply_pipeline([target], n_time_steps, pickled_data_path, balance_set=AppConfig.balance_data)
+        # The joint and every single target data set are independent of each other
+        target_sets = [targets] + [[target] for target in targets]
+        # Every worker still copies the features in create_target, so the number of workers is limited by AppConfig
+        n_workers = min(len(target_sets), os.cpu_count() or 1, AppConfig.max_pre_processing_workers)
+        with SharedMemoryManager() as shared_memory_manager:
+            # Read the parsed data once and share it with the workers instead of every worker reading it again
+            mimic_pp = MimicPreProcessor(parsed_mimic_filepath + '.parquet', random_seed=random_seed, targets=targets)
+            shared_data = share_data_frame(mimic_pp.parsed_mimic, shared_memory_manager, mimic_pp.numeric_cols,
+                                           id_col=mimic_pp.id_col)
+            del mimic_pp
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                # AppConfig values are passed explicitly because spawned workers re-import AppConfig with its defaults
+                futures = [executor.submit(pre_process_targets, shared_data, target_set,
+                                           n_time_steps, pickled_data_path, random_seed, AppConfig.balance_data)
+                           for target_set in target_sets]
+                for future in futures:
+                    future.result()
         print(f'Created Datasets for {targets}\n')
 
     if create_models:
@@ -142,8 +191,8 @@ if __name__ == "__main__":
         main(parse, pre_process, train)
     '''
 
-    for bd, os in [(True, False), (False, False), (False, True)]:
+    for bd, oversample in [(True, False), (False, False), (False, True)]:
         AppConfig.balance_data = bd
-        AppConfig.oversample = os
+        AppConfig.oversample = oversample
         print(f'{AppConfig.oversample=} - {AppConfig.balance_data=}')
         main(parse, pre_process, train)
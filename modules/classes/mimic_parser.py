@@ -4,6 +4,8 @@ import re
 
 import numpy as np
 import pandas as pd
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 from functools import reduce
 from modules.classes.item_id_parser import ItemIDParser
@@ -355,6 +357,19 @@ class MimicParser(object):
         df_shard.to_csv(self.an_path + '.csv', index=False)
         print("Added Notes")
 
+    def convert_to_parquet(self, file_path):
+        """
+        Persist a parsed csv file as parquet so that it can be loaded repeatedly without re-parsing
+        Parameters
+        ----------
+        file_path: str
+            path of the csv file without extension, the parquet file is saved next to it
+        """
+        read_options = pacsv.ReadOptions(use_threads=True, block_size=64 << 20)
+        table = pacsv.read_csv(file_path + '.csv', read_options=read_options)
+        pq.write_table(table, file_path + '.parquet', compression='snappy', row_group_size=200_000)
+        print(f"Converted {file_path} to parquet")
+
     def perform_full_parsing(self, window_size, create_statistics):
         """
         Call all methods of self to perform the full pipeline on a mimic db
@@ -368,7 +383,9 @@ class MimicParser(object):
         self.add_icd_infect()
         if self.mimic_version == 3:
             self.add_notes()
-            file_path = self.an_path + '.csv'
+            file_path = self.an_path
         else:
-            file_path = self.aii_path + '.csv'
+            file_path = self.aii_path
+        self.convert_to_parquet(file_path)
+        file_path += '.parquet'
         print(f"Finished Parsing MIMIC {self.mimic_version}\nFinal file can be found under:\n{file_path}")
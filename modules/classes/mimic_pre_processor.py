@@ -1,30 +1,32 @@
 import os
 
+from multiprocessing.shared_memory import SharedMemory
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 
 from modules.utils.handle_datasets import normalize_data, balance_data_set, split_data
 from modules.utils.pad_sequences import pad_sequences, filter_sequences
-from modules.utils.handle_directories import dump_pickle, get_pickle_file_path, load_pickle
-
-
-def wbc_criterion(x):
-    return (x > 12 or x < 4) and x != 0
+from modules.utils.handle_directories import dump_pickle, dump_mask, get_pickle_file_path, load_pickle
 
-
-def temp_criterion(x):
-    return (x > 100.4 or x < 96.8) and x != 0
+# Features that make every task trivial and are dropped for all targets
+TRIVIAL_FEATURES = ['subject_id', 'yob', 'admityear', 'ct_angio', 'infection', 'ckd']
+# Trivial features that are still needed to create a target
+TARGET_INPUT_FEATURES = {'MI': ['ckd'], 'SEPSIS': ['infection']}
 
 
 def save_data_to_disk(whole_data, mask, name, labels, output_folder, n_targets=1):
     """
-    Persist data to disk with pickle
+    Persist data to disk with pickle, masks are saved bit packed
     Parameters
     ----------
     whole_data: object
         dataset to be persisted
     mask: object
-        boolean mask of which entry is padded
+        boolean mask of which entry is padded, may be a read only view
     name: str
         filenames
     labels: list[str]
@@ -38,23 +40,81 @@ def save_data_to_disk(whole_data, mask, name, labels, output_folder, n_targets=1
     # because no targets exist
     input_data = whole_data[:, :-1, :-n_targets]
     targets = whole_data[:, 1:, -n_targets:]
-    targets = targets.reshape(targets.shape[0], targets.shape[1], n_targets)
     input_data_mask = mask[:, :-1, :-n_targets]
     targets_mask = mask[:, 1:, -n_targets:]
-    targets_mask = targets_mask.reshape(targets_mask.shape[0], targets_mask.shape[1], n_targets)
 
     assert input_data.shape == input_data_mask.shape
     assert targets.shape == targets_mask.shape
 
-    n_pos = np.count_nonzero(targets.sum(axis=1), axis=0)
+    n_pos = targets.any(axis=1).sum(axis=0)
     print(name)
     print(f'Number of positive patients {n_pos}')
     print(f'Number of neg patients {whole_data.shape[0] - n_pos}')
 
     dump_pickle(input_data, get_pickle_file_path(f'{name}_data', labels, output_folder))
     dump_pickle(targets, get_pickle_file_path(f'{name}_targets', labels, output_folder))
-    dump_pickle(input_data_mask, get_pickle_file_path(f'{name}_data_mask', labels, output_folder))
-    dump_pickle(targets_mask, get_pickle_file_path(f'{name}_targets_mask', labels, output_folder))
+    dump_mask(input_data_mask, get_pickle_file_path(f'{name}_data_mask', labels, output_folder))
+    dump_mask(targets_mask, get_pickle_file_path(f'{name}_targets_mask', labels, output_folder))
+
+
+def get_required_columns(file_path, targets):
+    """
+    Determine which columns of a parsed parquet file are needed to create the given targets
+    Parameters
+    ----------
+    file_path: str
+        path to the parquet file
+    targets: list[str]
+        target column(s)
+    Returns
+    -------
+    list of column names
+    """
+    # Columns that are always dropped in create_target and are not needed to compute any of the targets
+    target_inputs = {feature for target in targets for feature in TARGET_INPUT_FEATURES.get(target, [])}
+    unused_columns = set(TRIVIAL_FEATURES) - target_inputs
+    schema = pq.read_schema(file_path)
+    return [field.name for field in schema if field.name not in unused_columns
+            and (pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+                 or pa.types.is_boolean(field.type))]
+
+
+def share_data_frame(df, shared_memory_manager, columns, id_col='hadm_id'):
+    """
+    Copy a numeric dataframe into shared memory so that other processes can use it without reading it again.
+    The features are stored as one float64 block, the id column is kept as int64 in its own block
+    Parameters
+    ----------
+    df: object
+        dataframe to share
+    shared_memory_manager: object
+        SharedMemoryManager that owns the created blocks
+    columns: list[str]
+        numeric columns to share, has to contain the id column
+    id_col: str
+        id column of the dataframe
+    Returns
+    -------
+    dict with the names of the blocks as well as the layout of the shared frame
+    """
+    feature_cols = [col for col in columns if col != id_col]
+    shape = (len(df), len(feature_cols))
+    feature_memory = shared_memory_manager.SharedMemory(size=shape[0] * shape[1] * np.dtype(np.float64).itemsize)
+    id_memory = shared_memory_manager.SharedMemory(size=shape[0] * np.dtype(np.int64).itemsize)
+    # Fortran order keeps every column contiguous, which is also how pandas lays out a float block
+    features = np.ndarray(shape, dtype=np.float64, buffer=feature_memory.buf, order='F')
+    # Fill column by column so that no temporary copy of the whole frame is created
+    for i, col in enumerate(feature_cols):
+        features[:, i] = df[col].to_numpy(dtype=np.float64)
+    ids = np.ndarray(shape[:1], dtype=np.int64, buffer=id_memory.buf)
+    ids[:] = df[id_col].to_numpy(dtype=np.int64)
+    shared_data = {'feature_name': feature_memory.name, 'id_name': id_memory.name, 'shape': shape,
+                   'feature_cols': feature_cols, 'id_col': id_col, 'id_loc': columns.index(id_col)}
+    # The manager keeps the blocks alive, only this process' handles get closed
+    del features, ids
+    feature_memory.close()
+    id_memory.close()
+    return shared_data
 
 
 class MimicPreProcessor(object):
@@ -62,8 +122,31 @@ class MimicPreProcessor(object):
     Creates Data Sets for Machine learning from a parsed mimic file
     """
 
-    def __init__(self, mimic_file_path, id_col='hadm_id', random_seed=0):
-        self.parsed_mimic = pd.read_csv(mimic_file_path)
+    def __init__(self, mimic_file_path, id_col='hadm_id', random_seed=0, targets=None, shared_data=None):
+        self.shared_memories = []
+        if shared_data is not None:
+            # Attach to a frame created by share_data_frame, the blocks have to stay referenced while they are used
+            feature_memory = SharedMemory(name=shared_data['feature_name'])
+            id_memory = SharedMemory(name=shared_data['id_name'])
+            self.shared_memories = [feature_memory, id_memory]
+            shape = shared_data['shape']
+            features = np.ndarray(shape, dtype=np.float64, buffer=feature_memory.buf, order='F')
+            ids = np.ndarray(shape[:1], dtype=np.int64, buffer=id_memory.buf)
+            self.parsed_mimic = pd.DataFrame(features, columns=shared_data['feature_cols'], copy=False)
+            # The int id column becomes its own block, so the shared float block is not copied
+            self.parsed_mimic.insert(shared_data['id_loc'], shared_data['id_col'], ids)
+        elif mimic_file_path.endswith('.parquet'):
+            columns = None if targets is None else get_required_columns(mimic_file_path, targets)
+            self.parsed_mimic = pd.read_parquet(mimic_file_path, columns=columns, engine='pyarrow')
+        else:
+            # Arrow's multithreaded reader is a lot faster than pd.read_csv on the large parsed file
+            read_options = pacsv.ReadOptions(use_threads=True, block_size=64 << 20)
+            self.parsed_mimic = pacsv.read_csv(mimic_file_path,
+                                               read_options=read_options).to_pandas(self_destruct=True)
+        # The dtypes do not change between targets, so only inspect them once.
+        # Arrow parses date strings as timestamps, so explicitly keep only numeric columns
+        self.numeric_cols = list(self.parsed_mimic.select_dtypes(include=['number', 'bool']).columns)
+        self.numeric_col_set = set(self.numeric_cols)
         self.id_col = id_col
         self.random_seed = random_seed
 
@@ -78,27 +161,35 @@ class MimicPreProcessor(object):
         -------
         dataframe with target column(s) as well as a list of feature names
         """
-        df = self.parsed_mimic.copy()
+        df = self.parsed_mimic
+        target_columns = {}
         # Delete features that make the task trivial
-        trivial_features = ['subject_id', 'yob', 'admityear', 'ct_angio', 'infection', 'ckd']
+        trivial_features = list(TRIVIAL_FEATURES)
         if 'MI' in targets:
-            df['MI'] = ((df['troponin'] > 0.4) & (df['ckd'] == 0)).apply(lambda x: int(x))
+            target_columns['MI'] = ((df['troponin'].values > 0.4) & (df['ckd'].values == 0)).astype(np.int8)
             trivial_features += ['troponin', 'troponin_std', 'troponin_min', 'troponin_max']
         if 'SEPSIS' in targets:
-            hr_sepsis = df['heart rate'].apply(lambda x: 1 if x > 90 else 0)
-            respiratory_rate_sepsis = df['respiratory rate'].apply(lambda x: 1 if x > 20 else 0)
-            wbc_sepsis = df['wbcs'].apply(wbc_criterion)
-            temperature_f_sepsis = df['temperature (f)'].apply(temp_criterion)
+            hr_sepsis = (df['heart rate'].values > 90).astype(np.int8)
+            respiratory_rate_sepsis = (df['respiratory rate'].values > 20).astype(np.int8)
+            wbcs = df['wbcs'].values
+            wbc_sepsis = (((wbcs > 12) | (wbcs < 4)) & (wbcs != 0)).astype(np.int8)
+            temperature_f = df['temperature (f)'].values
+            temperature_f_sepsis = (((temperature_f > 100.4) | (temperature_f < 96.8))
+                                    & (temperature_f != 0)).astype(np.int8)
             sepsis_points = (hr_sepsis + respiratory_rate_sepsis + wbc_sepsis + temperature_f_sepsis)
-            df['SEPSIS'] = ((sepsis_points >= 2) & (df['infection'] == 1)).apply(lambda x: int(x))
+            target_columns['SEPSIS'] = ((sepsis_points >= 2) & (df['infection'].values == 1)).astype(np.int8)
         if 'VANCOMYCIN' in targets:
-            df['VANCOMYCIN'] = df['vancomycin'].apply(lambda x: 1 if x > 0 else 0)
+            target_columns['VANCOMYCIN'] = (df['vancomycin'].values > 0).astype(np.int8)
             trivial_features += ['vancomycin']
 
         print(f'Created target {targets}')
 
-        df = df.drop(trivial_features, axis=1, errors='ignore')
-        df = df.select_dtypes(exclude=['object'])
+        # drop copies the kept columns, this single copy replaces the former copy() plus drop
+        # and keeps self.parsed_mimic untouched for the other targets
+        dropped_cols = [col for col in df.columns if col in trivial_features or col not in self.numeric_col_set]
+        df = df.drop(dropped_cols, axis=1)
+        for target, values in target_columns.items():
+            df[target] = values
         return df
 
     def create_time_col(self, df, n_time_steps):
@@ -147,8 +238,9 @@ class MimicPreProcessor(object):
                                              random_state=self.random_seed)
             dump_pickle(train_ids, train_key_path)
             dump_pickle(test_ids, test_key_path)
-        train_data = df[df[self.id_col].isin(train_ids)]
-        test_data = df[df[self.id_col].isin(test_ids)]
+        id_arr = df[self.id_col].to_numpy()
+        train_data = df.iloc[np.flatnonzero(np.isin(id_arr, train_ids))]
+        test_data = df.iloc[np.flatnonzero(np.isin(id_arr, test_ids))]
 
         # +1 to also exclude the id col
         train_subset = train_data.iloc[:, :-(n_targets + 1)]
@@ -159,9 +251,9 @@ class MimicPreProcessor(object):
 
         print(f'{train_data.shape=} - {test_data.shape=}')
 
-        if np.isnan(train_data).any().any():
+        if train_data.isna().to_numpy().any():
             raise Exception('NaN Values remain in Train data')
-        if np.isnan(test_data).any().any():
+        if test_data.isna().to_numpy().any():
             raise Exception('NaN Values remain in Test data')
 
         return train_data, test_data
@@ -181,17 +273,15 @@ class MimicPreProcessor(object):
         -------
         padded data and boolean mask
         """
-        df = pad_sequences(df, time_steps, pad_value=pad_value, grouping_col=self.id_col)
-        df = df.drop(columns=[self.id_col])
-        whole_data = df.values
-        whole_data = whole_data.reshape(int(whole_data.shape[0] / time_steps), time_steps, whole_data.shape[1])
+        whole_data = pad_sequences(df, time_steps, pad_value=pad_value, grouping_col=self.id_col)
 
         # creating a second order bool matrix which keeps track of padded entries
-        mask = (~whole_data.any(axis=2))
-        whole_data[mask] = np.nan
-        # restore 3D shape to boolmatrix for consistency
-        mask = np.isnan(whole_data)
-        whole_data[mask] = pad_value
+        mask = ~whole_data.any(axis=2)
+        # Padded entries already hold pad_value, only all zero rows of the data have to be set as well
+        if pad_value != 0:
+            whole_data[mask] = pad_value
+        # 3D view of the mask for consistency, it only gets materialized when it is saved
+        mask = np.broadcast_to(mask[:, :, np.newaxis], whole_data.shape)
         print("Padded data frame")
         return whole_data, mask
 
@@ -214,8 +304,7 @@ class MimicPreProcessor(object):
             whether to balance the data
         """
         n_targets = len(targets)
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
+        os.makedirs(output_folder, exist_ok=True)
 
         df = self.create_target(targets)
         df = self.create_time_col(df, n_time_steps)
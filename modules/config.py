@@ -22,6 +22,8 @@ class AppConfig:
         whether to balance the data during pre processing
     oversample: bool
         whether to oversample the data
+    max_pre_processing_workers: int
+        maximum number of data sets created in parallel, every worker holds its own copy of the features
     """
     device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
     random_seed = 0
@@ -41,3 +43,5 @@ class AppConfig:
     create_statistics = False
     balance_data = True
     oversample = False
+
+    max_pre_processing_workers = 1
@@ -1,5 +1,6 @@
 from sklearn.model_selection import train_test_split
 import numpy as np
+import pandas as pd
 
 
 def get_series_label(df, id_col, target_col):
@@ -18,7 +19,7 @@ def get_series_label(df, id_col, target_col):
     -------
     For each group whether at least one label was positive or not
     """
-    return df.groupby(id_col, sort=False).apply(lambda group: (group[target_col] == 1).any())
+    return (df[target_col] == 1).groupby(df[id_col], sort=False).any()
 
 
 def split_data(data, id_col, target_col, train_size, random_state=0):
@@ -41,8 +42,9 @@ def split_data(data, id_col, target_col, train_size, random_state=0):
     Train and test set ids
     """
     print('Starting to prepare data')
-    ids = data[id_col].unique()
     y = get_series_label(data, id_col, target_col)
+    # The unsorted groupby keeps the ids in order of appearance, same as unique() would
+    ids = y.index.to_numpy()
     train_ids, test_ids = train_test_split(ids, train_size=train_size, random_state=random_state, stratify=y)
 
     return train_ids, test_ids
@@ -62,13 +64,20 @@ def normalize_data(train_data, test_data):
     -------
     Normalized data
     """
-    means = train_data.mean(axis=0)
-    stds = train_data.std(axis=0)
+    # Work on float32 arrays in place instead of creating intermediate float64 frames
+    train_values = train_data.to_numpy(dtype=np.float32, copy=True)
+    test_values = test_data.to_numpy(dtype=np.float32, copy=True)
+    # Accumulate the statistics in float64 to not lose precision on large data sets
+    means = train_values.mean(axis=0, dtype=np.float64).astype(np.float32)
+    stds = train_values.std(axis=0, dtype=np.float64, ddof=1).astype(np.float32)
     stds[stds == 0] = 1
 
-    train_data = (train_data - means) / stds
-    test_data = (test_data - means) / stds
+    for values in [train_values, test_values]:
+        values -= means
+        values /= stds
 
+    train_data = pd.DataFrame(train_values, index=train_data.index, columns=train_data.columns)
+    test_data = pd.DataFrame(test_values, index=test_data.index, columns=test_data.columns)
     return train_data, test_data
 
 
@@ -93,9 +102,11 @@ def balance_data_set(id_col, train_data, n_targets, undersample=True, imbalance=
     Balanced data
     """
     # Get the number of patients with at least one positive day for each target then take the sum
-    patients_grouped = train_data.groupby(id_col)
-    n_pos_per_patient = patients_grouped.agg('sum').iloc[:, -n_targets:]
-    n_pos_per_patient = n_pos_per_patient - patients_grouped.first().iloc[:, -n_targets:]
+    # Only aggregate the target columns, the features are not needed for counting
+    target_cols = list(train_data.columns[-n_targets:])
+    patients_grouped = train_data[[id_col] + target_cols].groupby(id_col, sort=False)
+    # Sort the small per patient result so that the shuffles below draw the same patients as a sorted groupby
+    n_pos_per_patient = (patients_grouped.sum() - patients_grouped.first()).sort_index()
 
     if undersample:
         # Take the biggest value of all possible minority counts
@@ -127,14 +138,13 @@ def balance_data_set(id_col, train_data, n_targets, undersample=True, imbalance=
     if undersample:
         total_ids = np.hstack([minority_class[:minority_length], majority_class[:int(minority_length * imbalance)]])
         np.random.shuffle(total_ids)
-        train_data = train_data[train_data[id_col].isin(total_ids)]
+        train_data = train_data.iloc[np.flatnonzero(np.isin(train_data[id_col].to_numpy(), total_ids))]
         print(f'{n_rows=} {len(pos_ids)=} - {len(neg_ids)=} - {len(total_ids)=}')
         print('Balanced training data by undersampling')
     else:
         difference = majority_class.shape[0] // minority_length
-        minority_data = train_data[train_data[id_col].isin(minority_class)]
-        for i in range(difference - 1):
-            train_data = train_data.append(minority_data)
+        minority_data = train_data.iloc[np.flatnonzero(np.isin(train_data[id_col].to_numpy(), minority_class))]
+        train_data = pd.concat([train_data] + [minority_data] * (difference - 1), copy=False)
         print(f'Added minority class {difference - 1} times')
         print('Balanced training data by oversampling')
     return train_data
@@ -1,5 +1,7 @@
 import pickle
 
+import numpy as np
+
 from modules.config import AppConfig
 
 
@@ -13,8 +15,9 @@ def dump_pickle(variable, path):
     path: str
         path of the saved file
     """
+    # Protocol 5 saves a copy for contiguous numpy arrays, sliced arrays are still copied by numpy
     with open(path, 'wb') as file:
-        pickle.dump(variable, file)
+        pickle.dump(variable, file, protocol=5)
 
 
 def load_pickle(path):
@@ -33,6 +36,37 @@ def load_pickle(path):
     return variable
 
 
+def dump_mask(mask, path):
+    """
+    Save a boolean mask bit packed via pickle
+    Parameters
+    ----------
+    mask: object
+        boolean array with the sample dimension first
+    path: str
+        path of the saved file
+    """
+    packed_mask = np.packbits(mask.reshape(mask.shape[0], -1), axis=1)
+    dump_pickle({'shape': mask.shape, 'packed_mask': packed_mask}, path)
+
+
+def load_mask(path):
+    """
+    Load a boolean mask saved by dump_mask
+    Parameters
+    ----------
+    path: str
+        path of the saved file
+    Returns
+    -------
+    unpacked boolean mask
+    """
+    variable = load_pickle(path)
+    shape = variable['shape']
+    mask = np.unpackbits(variable['packed_mask'], axis=1, count=int(np.prod(shape[1:])))
+    return mask.reshape(shape).astype(bool)
+
+
 def get_output_directory(create_statistics=None, undersample=None, oversample=None):
     """
     Determines the output directory given the balance of the dataset as well as columns.